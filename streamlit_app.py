@@ -1,12 +1,41 @@
+import threading
+import time
+import uuid
+
 import streamlit as st
 import pandas as pd
+from pandas.tseries.api import guess_datetime_format
 from snowflake.snowpark import Session
+from snowflake.snowpark.context import get_active_session
+from snowflake.snowpark.exceptions import SnowparkSessionException
+from snowflake.snowpark import functions as F
+from snowflake.snowpark.functions import col
 
 # ---------------------------
-# Snowflake session (Streamlit Cloud compatible)
+# Snowflake session (Streamlit in Snowflake or Streamlit Cloud)
 # ---------------------------
-cfg = st.secrets["connections"]["snowflake"]
-session = Session.builder.configs(cfg).create()
+def session_is_open(session):
+    return not session.connection.is_closed()
+
+
+@st.cache_resource(show_spinner=False, validate=session_is_open)
+def get_session():
+    """One Snowpark session per server process, reused across reruns.
+
+    Recreated if its connection has been closed; keep-alive stops Snowflake
+    expiring it while the app sits idle.
+    """
+    try:
+        return get_active_session()
+    except SnowparkSessionException:
+        cfg = {
+            **st.secrets["connections"]["snowflake"],
+            "client_session_keep_alive": True,
+        }
+        return Session.builder.configs(cfg).create()
+
+
+session = get_session()
 
 # ---------------------------
 # Streamlit page config
@@ -19,114 +48,324 @@ st.set_page_config(
 st.title("🥖 French Bakery Sales & Inventory Tracker")
 
 # ---------------------------
-# Load data
+# Load data (aggregated in Snowflake)
 # ---------------------------
-@st.cache_data
-def load_data():
-    query = """
-        SELECT SALE_ID, SALE_DATE, PRODUCT, QUANTITY, UNIT_PRICE, STOCK_QUANTITY
-        FROM SALES
+KEY_COLUMNS = ["SALE_DATE", "PRODUCT", "QUANTITY", "UNIT_PRICE"]
+DETAIL_ROW_LIMIT = 500
+CACHE_TTL = 600
+DASHBOARD_CACHE_ENTRIES = 32
+EXPORT_CACHE_ENTRIES = 4
+UPLOAD_CHUNK_ROWS = 10_000
+
+
+@st.cache_resource(show_spinner=False)
+def snapshot_state():
+    """Process-wide bookkeeping for the cleaned SALES snapshot."""
+    return {
+        "lock": threading.Lock(),
+        "session": None,
+        "table": None,
+        "built_at": 0.0,
+        "retired": None,
+    }
+
+
+def current_snapshot():
+    """Name of the cleaned SALES snapshot every browser session reads.
+
+    Materialized as a Snowflake temp table so chart queries don't rescan
+    SALES. It is rebuilt after CACHE_TTL seconds, or on the next run after
+    refresh_sales(). The previous table is only dropped at the rebuild after
+    that, so sessions still querying it can finish. Cached functions take
+    the name as an argument, so results from an old snapshot are never
+    served for a new one.
     """
-    df = session.sql(query).to_pandas()
+    state = snapshot_state()
+    with state["lock"]:
+        if state["session"] is not session:
+            # Temp tables die with the session that created them
+            state.update(session=session, table=None, retired=None)
+        if (
+            state["table"] is None
+            or time.monotonic() - state["built_at"] > CACHE_TTL
+        ):
+            if state["retired"] is not None:
+                state["retired"].drop_table()
+            state["retired"] = state["table"]
+            state["table"] = build_clean_sales().cache_result()
+            state["built_at"] = time.monotonic()
+        return state["table"].table_name
+
+
+def refresh_sales():
+    """Mark the snapshot stale after SALES is modified."""
+    state = snapshot_state()
+    with state["lock"]:
+        state["built_at"] = float("-inf")
+
+
+def clean_sales(snapshot):
+    """SALES with cleaned product names and per-row REVENUE and WEEK columns,
+    null and duplicate rows removed."""
+    return session.table(snapshot)
+
+
+def build_clean_sales():
+    # Keep the earliest SALE_ID of each duplicate sale
+    return session.sql("""
+        SELECT
+            SALE_ID,
+            SALE_DATE,
+            UPPER(TRIM(PRODUCT)) AS PRODUCT,
+            QUANTITY,
+            UNIT_PRICE,
+            STOCK_QUANTITY,
+            QUANTITY * UNIT_PRICE AS REVENUE,
+            DATE_TRUNC('WEEK', SALE_DATE) AS WEEK
+        FROM SALES
+        WHERE SALE_DATE IS NOT NULL
+        AND PRODUCT IS NOT NULL
+        AND QUANTITY IS NOT NULL
+        AND UNIT_PRICE IS NOT NULL
+        QUALIFY ROW_NUMBER() OVER (
+            PARTITION BY SALE_DATE, UPPER(TRIM(PRODUCT)), QUANTITY, UNIT_PRICE
+            ORDER BY SALE_ID
+        ) = 1
+    """)
+
+
+def filtered_sales(snapshot, products, start_date, end_date):
+    """Cleaned SALES restricted to the sidebar filters (pushed down to Snowflake)."""
+    return clean_sales(snapshot).filter(
+        col("PRODUCT").isin(list(products))
+        & col("SALE_DATE").between(start_date, end_date)
+    )
+
+
+def revenue():
+    return F.sum("REVENUE").alias("REVENUE")
 
-    # Ensure SALE_DATE is datetime
-    df["SALE_DATE"] = pd.to_datetime(df["SALE_DATE"], errors="coerce")
 
-    # Clean product names
-    df["PRODUCT"] = df["PRODUCT"].astype(str).str.strip().str.upper()
+def to_pandas(sdf):
+    """Fetch a Snowpark DataFrame as Arrow-backed pandas columns."""
+    return sdf.to_arrow().to_pandas(types_mapper=pd.ArrowDtype)
 
-    # Remove rows with null critical fields
-    df = df.dropna(subset=["SALE_DATE", "PRODUCT", "QUANTITY", "UNIT_PRICE"])
 
-    # ✅ REMOVE DUPLICATES (important)
-    df = df.drop_duplicates(
-        subset=["SALE_DATE", "PRODUCT", "QUANTITY", "UNIT_PRICE"]
+@st.cache_data(ttl=CACHE_TTL)
+def get_filter_options(snapshot):
+    products = [
+        row["PRODUCT"]
+        for row in clean_sales(snapshot)
+        .select("PRODUCT")
+        .distinct()
+        .sort("PRODUCT")
+        .collect()
+    ]
+    bounds = clean_sales(snapshot).agg(
+        F.min("SALE_DATE").alias("MIN_DATE"),
+        F.max("SALE_DATE").alias("MAX_DATE"),
+    ).collect()[0]
+    return products, bounds["MIN_DATE"], bounds["MAX_DATE"]
+
+
+def get_kpis(snapshot, products, start_date, end_date):
+    # DISTINCT and WITHIN GROUP must refer to the same expression
+    low_stock_product = F.iff(
+        col("STOCK_QUANTITY") < 10, col("PRODUCT"), F.lit(None)
+    )
+    row = filtered_sales(snapshot, products, start_date, end_date).agg(
+        F.count("*").alias("ROW_COUNT"),
+        revenue(),
+        F.sum("QUANTITY").alias("UNITS"),
+        F.listagg(low_stock_product, ", ", is_distinct=True)
+        .within_group(low_stock_product)
+        .alias("LOW_STOCK"),
+    ).collect()[0]
+    return row.as_dict()
+
+
+def get_daily_revenue(snapshot, products, start_date, end_date):
+    return to_pandas(
+        filtered_sales(snapshot, products, start_date, end_date)
+        .group_by("SALE_DATE")
+        .agg(revenue())
+    )
+
+
+def get_weekly_revenue(snapshot, products, start_date, end_date):
+    return to_pandas(
+        filtered_sales(snapshot, products, start_date, end_date)
+        .group_by("WEEK")
+        .agg(revenue())
+    )
+
+
+def get_product_revenue(snapshot, products, start_date, end_date):
+    return to_pandas(
+        filtered_sales(snapshot, products, start_date, end_date)
+        .group_by("PRODUCT")
+        .agg(revenue())
+        .sort(col("REVENUE").desc())
+    )
+
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=DASHBOARD_CACHE_ENTRIES)
+def compute_dashboard(snapshot, products, start_date, end_date):
+    """All KPIs and chart aggregates for one filter selection.
+
+    Cached as a whole so an unchanged rerun is a single cache lookup.
+    """
+    filters = (snapshot, products, start_date, end_date)
+    kpis = get_kpis(*filters)
+    if kpis["ROW_COUNT"] == 0:
+        return {"kpis": kpis}
+    return {
+        "kpis": kpis,
+        "daily": get_daily_revenue(*filters),
+        "weekly": get_weekly_revenue(*filters),
+        "by_product": get_product_revenue(*filters),
+    }
+
+
+def sales_detail(snapshot, products, start_date, end_date):
+    return (
+        filtered_sales(snapshot, products, start_date, end_date)
+        .drop("WEEK", "REVENUE")
+        .sort("SALE_DATE")
+    )
+
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=DASHBOARD_CACHE_ENTRIES)
+def get_sales_detail(snapshot, products, start_date, end_date, limit):
+    df = to_pandas(
+        sales_detail(snapshot, products, start_date, end_date).limit(limit)
+    )
+
+    # Low-cardinality product names: store as codes, not repeated strings.
+    # Counts fit in int32; prices keep full precision.
+    df = df.astype(
+        {
+            "PRODUCT": "category",
+            "QUANTITY": "int32[pyarrow]",
+            "STOCK_QUANTITY": "int32[pyarrow]",
+        }
     )
 
     return df
 
-df = load_data()
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=EXPORT_CACHE_ENTRIES)
+def get_sales_csv(snapshot, products, start_date, end_date):
+    """Full filtered export, encoded once per filter selection."""
+    df = to_pandas(sales_detail(snapshot, products, start_date, end_date))
+    return df.to_csv(index=False).encode("utf-8")
+
+
+@st.cache_data(ttl=CACHE_TTL)
+def get_stock_levels(snapshot):
+    return to_pandas(
+        clean_sales(snapshot)
+        .group_by("PRODUCT")
+        .agg(F.sum("STOCK_QUANTITY").alias("STOCK_QUANTITY"))
+        .filter(col("STOCK_QUANTITY") < 10)
+        .sort("STOCK_QUANTITY")
+    )
+
+
+def guess_date_format(dates):
+    """Date format of the first non-empty value, or None if it can't be told."""
+    dates = dates.dropna()
+    if dates.empty:
+        return None
+    return guess_datetime_format(str(dates.iloc[0]))
+
+
+def clean_upload(chunk, date_format):
+    """Normalise one CSV chunk to the SALES key columns."""
+    chunk["SALE_DATE"] = pd.to_datetime(
+        chunk["SALE_DATE"], format=date_format, errors="coerce"
+    )
+    # PRODUCT is read as string[pyarrow], so these run as Arrow compute kernels
+    chunk["PRODUCT"] = chunk["PRODUCT"].str.strip().str.upper()
+
+    chunk = chunk.dropna(subset=KEY_COLUMNS)
+
+    # ✅ Remove duplicates inside CSV
+    chunk = chunk.drop_duplicates(subset=KEY_COLUMNS)
+
+    return (
+        chunk[KEY_COLUMNS]
+        .assign(SALE_DATE=chunk["SALE_DATE"].dt.date)
+        .reset_index(drop=True)
+    )
+
+
+snapshot = current_snapshot()
+products, min_date, max_date = get_filter_options(snapshot)
 
 # ---------------------------
 # Sidebar Filters
 # ---------------------------
 st.sidebar.header("Filters")
 
-products = sorted(df["PRODUCT"].unique())
 selected_products = st.sidebar.multiselect(
     "Select Products", products, default=products
 )
 
-min_date = df["SALE_DATE"].min()
-max_date = df["SALE_DATE"].max()
 date_range = st.sidebar.date_input(
     "Select Date Range", [min_date, max_date]
 )
 
+page_size = st.sidebar.number_input(
+    "Rows", min_value=50, max_value=5000, value=DETAIL_ROW_LIMIT, step=50
+)
+
 # Ensure date_range has 2 dates
+dashboard = None
 if len(date_range) == 2:
-    start_date = pd.to_datetime(date_range[0])
-    end_date = pd.to_datetime(date_range[1])
-    filtered_df = df[
-        (df["PRODUCT"].isin(selected_products))
-        & (df["SALE_DATE"] >= start_date)
-        & (df["SALE_DATE"] <= end_date)
-    ]
+    start_date, end_date = date_range
+    filters = (
+        snapshot, tuple(sorted(selected_products)), start_date, end_date
+    )
+    if selected_products:
+        dashboard = compute_dashboard(*filters)
 else:
     st.warning("Please select a start and end date.")
-    filtered_df = pd.DataFrame()  # empty df to avoid crashes
 
 
 # ---------------------------
 # Display KPIs and Charts
 # ---------------------------
-if filtered_df.empty:
+if not dashboard or dashboard["kpis"]["ROW_COUNT"] == 0:
     st.warning("No data to display for the selected filters.")
 else:
     st.subheader("Key Metrics")
 
-    total_revenue = (filtered_df["QUANTITY"] * filtered_df["UNIT_PRICE"]).sum()
-    total_units = filtered_df["QUANTITY"].sum()
-    low_stock = filtered_df[filtered_df["STOCK_QUANTITY"] < 10]["PRODUCT"].tolist()
+    total_revenue = dashboard["kpis"]["REVENUE"]
+    total_units = dashboard["kpis"]["UNITS"]
+    low_stock = dashboard["kpis"]["LOW_STOCK"]
 
     col1, col2, col3 = st.columns(3)
     col1.metric("💰 Total Revenue", f"€{total_revenue:,.2f}")
     col2.metric("📦 Total Units Sold", int(total_units))
     col3.metric(
         "⚠️ Low Stock Products",
-        ", ".join(sorted(set(low_stock))) if low_stock else "None",
+        low_stock or "None",
     )
 
     # Daily Revenue
     st.subheader("Daily Revenue")
-    daily_revenue = (
-        filtered_df.groupby("SALE_DATE")
-        .apply(lambda x: (x["QUANTITY"] * x["UNIT_PRICE"]).sum())
-        .reset_index()
-    )
-    daily_revenue.columns = ["SALE_DATE", "REVENUE"]
+    daily_revenue = dashboard["daily"]
     st.line_chart(daily_revenue.set_index("SALE_DATE")["REVENUE"])
 
     # Weekly Revenue
     st.subheader("Weekly Revenue Trends")
-    filtered_df["WEEK"] = filtered_df["SALE_DATE"].dt.isocalendar().week
-    weekly_revenue = (
-        filtered_df.groupby("WEEK")
-        .apply(lambda x: (x["QUANTITY"] * x["UNIT_PRICE"]).sum())
-        .reset_index()
-    )
-    weekly_revenue.columns = ["WEEK", "REVENUE"]
+    weekly_revenue = dashboard["weekly"]
     st.line_chart(weekly_revenue.set_index("WEEK")["REVENUE"])
 
     # Revenue by Product
     st.subheader("Revenue by Product")
-    product_revenue = (
-        filtered_df.groupby("PRODUCT")
-        .apply(lambda x: (x["QUANTITY"] * x["UNIT_PRICE"]).sum())
-        .reset_index()
-    )
-    product_revenue.columns = ["PRODUCT", "REVENUE"]
-    product_revenue = product_revenue.sort_values("REVENUE", ascending=False)
+    product_revenue = dashboard["by_product"]
     st.bar_chart(product_revenue.set_index("PRODUCT")["REVENUE"])
 
     # Top 5 Products
@@ -135,17 +374,23 @@ else:
 
     # Data Table
     st.subheader("Sales Data")
-    st.dataframe(filtered_df)
+    row_count = dashboard["kpis"]["ROW_COUNT"]
+    st.caption(f"Showing {min(page_size, row_count)} of {row_count} rows.")
+    st.dataframe(get_sales_detail(*filters, limit=page_size))
 
     # Download Filtered Data
     st.subheader("Download Filtered Data")
-    csv = filtered_df.to_csv(index=False).encode("utf-8")
-    st.download_button(
-        label="📥 Download CSV",
-        data=csv,
-        file_name="filtered_sales.csv",
-        mime="text/csv",
-    )
+    # Only fetch and encode the full export once it is asked for
+    if st.button("Prepare CSV"):
+        st.session_state["export_filters"] = filters
+    if st.session_state.get("export_filters") == filters:
+        csv = get_sales_csv(*filters)
+        st.download_button(
+            label="📥 Download CSV",
+            data=csv,
+            file_name="filtered_sales.csv",
+            mime="text/csv",
+        )
 
 # ---------------------------
 # Add New Sale (manual entry)
@@ -160,14 +405,15 @@ with st.sidebar.form("add_sale_form"):
     submit_sale = st.form_submit_button("Add Sale")
 
     if submit_sale:
-        session.sql(f"""
+        session.sql(
+            """
             MERGE INTO SALES t
             USING (
                 SELECT
-                    '{sale_date}' AS SALE_DATE,
-                    '{product}' AS PRODUCT,
-                    {quantity} AS QUANTITY,
-                    {unit_price} AS UNIT_PRICE
+                    ? AS SALE_DATE,
+                    ? AS PRODUCT,
+                    ? AS QUANTITY,
+                    ? AS UNIT_PRICE
             ) s
             ON t.SALE_DATE = s.SALE_DATE
             AND t.PRODUCT = s.PRODUCT
@@ -176,7 +422,10 @@ with st.sidebar.form("add_sale_form"):
             WHEN NOT MATCHED THEN
             INSERT (SALE_DATE, PRODUCT, QUANTITY, UNIT_PRICE, STOCK_QUANTITY)
             VALUES (s.SALE_DATE, s.PRODUCT, s.QUANTITY, s.UNIT_PRICE, 0)
-        """).collect()
+            """,
+            params=[sale_date, product, quantity, unit_price],
+        ).collect()
+        refresh_sales()
 
         st.success(f"Sale added for {product}! Refresh to see updates.")
 
@@ -187,34 +436,42 @@ st.sidebar.header("Upload Sales CSV")
 
 uploaded_file = st.sidebar.file_uploader("Upload CSV", type=["csv"])
 
-if uploaded_file:
-    new_sales = pd.read_csv(uploaded_file)
-
-    new_sales["SALE_DATE"] = pd.to_datetime(
-        new_sales["SALE_DATE"], errors="coerce"
-    )
-    new_sales["PRODUCT"] = (
-        new_sales["PRODUCT"].astype(str).str.strip().str.upper()
-    )
-
-    new_sales = new_sales.dropna(
-        subset=["SALE_DATE", "PRODUCT", "QUANTITY", "UNIT_PRICE"]
-    )
-
-    # ✅ Remove duplicates inside CSV
-    new_sales = new_sales.drop_duplicates(
-        subset=["SALE_DATE", "PRODUCT", "QUANTITY", "UNIT_PRICE"]
-    )
-
-    for _, row in new_sales.iterrows():
-        session.sql(f"""
+# Only load each uploaded file once, not on every rerun it stays attached
+if uploaded_file and st.session_state.get("loaded_upload") != uploaded_file.file_id:
+    # Stream the CSV into a temp table chunk by chunk, then merge it in
+    # one statement; memory is bounded by the chunk size, not the file.
+    # The session is shared, so each upload stages into its own table.
+    upload_table = f"SALES_UPLOAD_{uuid.uuid4().hex.upper()}"
+    # Copy the key column types from SALES so values are staged unchanged
+    session.sql(f"""
+        CREATE TEMPORARY TABLE {upload_table} AS
+        SELECT SALE_DATE, PRODUCT, QUANTITY, UNIT_PRICE
+        FROM SALES
+        LIMIT 0
+    """).collect()
+    try:
+        chunks = pd.read_csv(
+            uploaded_file,
+            chunksize=UPLOAD_CHUNK_ROWS,
+            dtype={"PRODUCT": "string[pyarrow]"},
+        )
+        # Fix the date format from the start of the file so every chunk
+        # parses ambiguous dates (03/04/2024) the same way
+        date_format = None
+        for chunk in chunks:
+            if date_format is None:
+                date_format = guess_date_format(chunk["SALE_DATE"])
+            session.write_pandas(
+                clean_upload(chunk, date_format),
+                upload_table,
+                auto_create_table=False,
+            )
+        result = session.sql(f"""
             MERGE INTO SALES t
             USING (
-                SELECT
-                    '{row["SALE_DATE"].date()}' AS SALE_DATE,
-                    '{row["PRODUCT"]}' AS PRODUCT,
-                    {row["QUANTITY"]} AS QUANTITY,
-                    {row["UNIT_PRICE"]} AS UNIT_PRICE
+                -- Duplicates can span chunks
+                SELECT DISTINCT SALE_DATE, PRODUCT, QUANTITY, UNIT_PRICE
+                FROM {upload_table}
             ) s
             ON t.SALE_DATE = s.SALE_DATE
             AND t.PRODUCT = s.PRODUCT
@@ -224,21 +481,20 @@ if uploaded_file:
             INSERT (SALE_DATE, PRODUCT, QUANTITY, UNIT_PRICE, STOCK_QUANTITY)
             VALUES (s.SALE_DATE, s.PRODUCT, s.QUANTITY, s.UNIT_PRICE, 0)
         """).collect()
+    finally:
+        session.sql(f"DROP TABLE IF EXISTS {upload_table}").collect()
+    inserted = result[0]["number of rows inserted"]
+    refresh_sales()
+    st.session_state["loaded_upload"] = uploaded_file.file_id
 
-    st.success(f"{len(new_sales)} new sales loaded without duplicates!")
+    st.success(f"{inserted} new sales loaded without duplicates!")
 
 # ---------------------------
 # Low Stock Products (Aggregated)
 # ---------------------------
 st.subheader("⚠️ Low Stock Products (Full List)")
 
-low_stock_df = (
-    df.groupby("PRODUCT", as_index=False)
-    .agg({"STOCK_QUANTITY": "sum"})
-    .sort_values("STOCK_QUANTITY")
-)
-
-low_stock_df = low_stock_df[low_stock_df["STOCK_QUANTITY"] < 10]
+low_stock_df = get_stock_levels(snapshot)
 
 if low_stock_df.empty:
     st.info("All products have sufficient stock.")